@@ -1,12 +1,14 @@
 import asyncio
 import os
+import shlex
 from contextlib import asynccontextmanager
-from typing import Optional, Set
+from typing import Dict, FrozenSet, List, Optional, Set, Tuple
 from urllib.parse import urlparse
 
 from playwright.async_api import (
     async_playwright,
     Browser,
+    BrowserContext,
     Playwright,
     Error as PlaywrightError,
     TimeoutError as PlaywrightTimeoutError,
@@ -25,12 +27,74 @@ def _parse_csv(name: str) -> Set[str]:
     return {v.strip().lower() for v in val.split(",") if v.strip()}
 
 
+def _fast_host(url: str) -> Optional[str]:
+    # AnyHttpUrl always yields http(s); anything else takes the full parser.
+    if not url.startswith(("http://", "https://")):
+        return urlparse(url).hostname
+    start = url.index("://") + 3
+    end = len(url)
+    # Backslash ends the authority for http(s) in browsers, so treat it like "/".
+    for sep in "/?#\\":
+        i = url.find(sep, start, end)
+        if i != -1:
+            end = i
+    at = url.rfind("@", start, end)
+    if at != -1:
+        start = at + 1
+    netloc = url[start:end]
+    if netloc.startswith("["):
+        close = netloc.find("]")
+        host = netloc[1:close] if close != -1 else netloc[1:]
+    else:
+        colon = netloc.rfind(":")
+        host = netloc[:colon] if colon != -1 else netloc
+    return host.lower() or None
+
+
+def time_left(deadline: Optional[float]) -> Optional[float]:
+    if deadline is None:
+        return None
+    return max(deadline - asyncio.get_running_loop().time(), 0)
+
+
 class BrowserUnavailableError(RuntimeError):
     pass
 
 
 class BrowserManager:
-    DEFAULT_LAUNCH_ARGS = ["--no-sandbox", "--disable-dev-shm-usage"]
+    __slots__ = (
+        "headless",
+        "timeout_ms",
+        "block_resource_types",
+        "_block",
+        "allowed_hosts",
+        "_exact",
+        "_suffixes",
+        "context_pool_size",
+        "context_max_reuse",
+        "cdp_url",
+        "launch_args",
+        "_playwright",
+        "browser",
+        "_start_lock",
+        "_ctx_pool",
+        "_ctx_uses",
+        "_late_discards",
+    )
+
+    # Playwright already passes the usual background/breakpad/extension switches (and its
+    # own --disable-features list, which a second --disable-features would replace), so
+    # only add what it doesn't. --single-process is left out: one renderer crash would
+    # take down every context sharing the browser.
+    DEFAULT_LAUNCH_ARGS = [
+        "--no-sandbox",
+        "--disable-dev-shm-usage",
+        "--disable-gpu",
+        "--disable-sync",
+    ]
+    _FULFILL_EMPTY_TYPES = frozenset({"image", "media", "font"})
+    # Pooled contexts all use this viewport; pages needing another size are resized.
+    DEFAULT_VIEWPORT = (1280, 800)
 
     def __init__(
         self,
@@ -38,14 +102,43 @@ class BrowserManager:
         timeout_ms: int = 30000,
         block_resource_types: Optional[Set[str]] = None,
         allowed_hosts: Optional[Set[str]] = None,
+        context_pool_size: int = 4,
+        context_max_reuse: int = 1,
+        cdp_url: Optional[str] = None,
+        extra_launch_args: Optional[List[str]] = None,
     ):
         self.headless = headless
         self.timeout_ms = timeout_ms
         self.block_resource_types = block_resource_types or set()
+        self._block: FrozenSet[str] = frozenset(t.lower() for t in self.block_resource_types)
         self.allowed_hosts = allowed_hosts or set()
+        # Pre-normalized allow-list: exact hostnames plus ".suffix" tuples for "*." wildcards.
+        exact = set()
+        suffixes = []
+        for entry in self.allowed_hosts:
+            entry = entry.lower()
+            if entry.startswith("*."):
+                exact.add(entry[2:])
+                suffixes.append("." + entry[2:])
+            else:
+                exact.add(entry)
+        self._exact: FrozenSet[str] = frozenset(exact)
+        self._suffixes: Tuple[str, ...] = tuple(suffixes)
+        if context_pool_size < 0:
+            raise ValueError("context_pool_size must be >= 0")
+        # 0 disables pooling (an asyncio queue with maxsize=0 would be unbounded).
+        self.context_pool_size = context_pool_size
+        self.context_max_reuse = context_max_reuse
+        self.cdp_url = cdp_url
+        self.launch_args = [*self.DEFAULT_LAUNCH_ARGS, *(extra_launch_args or [])]
         self._playwright: Optional[Playwright] = None
         self.browser: Optional[Browser] = None
         self._start_lock = asyncio.Lock()
+        # Idle contexts (bounded by context_pool_size), plus how many requests each has served.
+        self._ctx_pool: asyncio.LifoQueue = asyncio.LifoQueue(maxsize=context_pool_size)
+        self._ctx_uses: Dict[int, int] = {}
+        # Strong refs for close tasks of contexts that finished starting after a timeout.
+        self._late_discards: Set[asyncio.Task] = set()
 
     @classmethod
     def from_env(cls):
@@ -56,11 +149,22 @@ class BrowserManager:
         if block_resources and not block_types:
             block_types = {"image", "media", "font"}
         allowed_hosts = _parse_csv("ALLOWED_HOSTS")
+        context_pool_size = int(os.getenv("CONTEXT_POOL_SIZE", "4"))
+        # Reuse is opt-in: only cookies and permissions are reset between requests, so
+        # localStorage, IndexedDB, service workers and the HTTP cache carry over.
+        context_max_reuse = int(os.getenv("CONTEXT_MAX_REUSE", "1"))
+        cdp_url = os.getenv("SHARED_CDP_URL") or None
+        # Whitespace-separated; flags like --disable-features=A,B contain commas.
+        extra_launch_args = shlex.split(os.getenv("BROWSER_EXTRA_ARGS", ""))
         return cls(
             headless=headless,
             timeout_ms=timeout_ms,
             block_resource_types=block_types if block_resources or block_types else set(),
             allowed_hosts=allowed_hosts,
+            context_pool_size=context_pool_size,
+            context_max_reuse=context_max_reuse,
+            cdp_url=cdp_url,
+            extra_launch_args=extra_launch_args,
         )
 
     async def start(self):
@@ -68,12 +172,20 @@ class BrowserManager:
             if self.browser is not None:
                 return
             self._playwright = await async_playwright().start()
-            self.browser = await self._playwright.chromium.launch(
-                headless=self.headless, args=self.DEFAULT_LAUNCH_ARGS
-            )
+            if self.cdp_url:
+                # Attach to a Chromium shared by all workers (see cdp_sidecar.py);
+                # close() then only disconnects and drops our own contexts.
+                self.browser = await self._playwright.chromium.connect_over_cdp(self.cdp_url)
+            else:
+                self.browser = await self._playwright.chromium.launch(
+                    headless=self.headless, args=self.launch_args
+                )
 
     async def stop(self):
         async with self._start_lock:
+            # Closing the browser closes every pooled context with it.
+            self._ctx_pool = asyncio.LifoQueue(maxsize=self.context_pool_size)
+            self._ctx_uses.clear()
             if self.browser:
                 await self.browser.close()
                 self.browser = None
@@ -88,42 +200,139 @@ class BrowserManager:
         if not self.allowed_hosts:
             return True
 
-        hostname = urlparse(url).hostname
+        hostname = _fast_host(url)
         if not hostname:
             return False
-        hostname = hostname.lower()
-        for entry in self.allowed_hosts:
-            entry = entry.lower()
-            if entry.startswith("*."):
-                if hostname == entry[2:] or hostname.endswith("." + entry[2:]):
-                    return True
-            elif hostname == entry:
-                return True
-        return False
+        # _fast_host (and urlparse) already return a lowercased hostname.
+        return hostname in self._exact or hostname.endswith(self._suffixes)
 
-    @asynccontextmanager
-    async def page_context(self, *, width: int = 1280, height: int = 800):
+    async def settle(self, page, *, fonts: bool = False) -> None:
+        # After DOMContentLoaded, give slow-tail resources a short, bounded chance to finish.
+        try:
+            await page.wait_for_load_state("networkidle", timeout=min(2000, self.timeout_ms))
+        except PlaywrightTimeoutError:
+            pass
+        if fonts:
+            await page.evaluate("() => document.fonts.ready.then(() => true)")
+
+    async def _route(self, route) -> None:
+        # Playwright resource types are already lowercase.
+        resource_type = route.request.resource_type
+        if resource_type not in self._block:
+            await route.continue_()
+        elif resource_type in self._FULFILL_EMPTY_TYPES:
+            # An empty 204 settles the page's load state without the failed-request
+            # logging and re-fetch heuristics that abort() can trigger.
+            await route.fulfill(status=204, body=b"", headers={"content-length": "0"})
+        else:
+            await route.abort()
+
+    async def _new_context(self) -> BrowserContext:
+        width, height = self.DEFAULT_VIEWPORT
+        context = await self.browser.new_context(viewport={"width": width, "height": height})
+
+        if self._block:
+            # Registered once per context; it survives reuse from the pool.
+            await context.route("**/*", self._route)
+
+        self._ctx_uses[id(context)] = 0
+        return context
+
+    async def warm_contexts(self, count: int):
         if not self.browser:
             raise BrowserUnavailableError("Browser is not started")
+        pool = self._ctx_pool
+        count = min(count, pool.maxsize - pool.qsize())
+        results = await asyncio.gather(
+            *(self._new_context() for _ in range(count)), return_exceptions=True
+        )
+        contexts = [r for r in results if not isinstance(r, BaseException)]
+        errors = [r for r in results if isinstance(r, BaseException)]
+        if errors:
+            # Don't leave the contexts that did start orphaned in Chromium.
+            for context in contexts:
+                await self._discard_context(context)
+            raise errors[0]
+        for context in contexts:
+            pool.put_nowait(context)
 
-        context = await self.browser.new_context(viewport={"width": width, "height": height})
+    def _pool_has_room(self) -> bool:
+        return self.context_pool_size > 0 and not self._ctx_pool.full()
+
+    async def _acquire_context(self, timeout: Optional[float]) -> BrowserContext:
+        try:
+            return self._ctx_pool.get_nowait()
+        except asyncio.QueueEmpty:
+            pass
+        # Shielded so a timeout can't drop a context Chromium goes on to create anyway.
+        creating = asyncio.ensure_future(self._new_context())
+        try:
+            return await asyncio.wait_for(asyncio.shield(creating), timeout)
+        except BaseException:
+            creating.add_done_callback(self._discard_late_context)
+            raise
 
-        if self.block_resource_types:
+    def _discard_late_context(self, creating: asyncio.Future) -> None:
+        if creating.cancelled() or creating.exception() is not None:
+            return
+        task = asyncio.ensure_future(self._discard_context(creating.result()))
+        self._late_discards.add(task)
+        task.add_done_callback(self._late_discards.discard)
 
-            async def route_handler(route):
-                if route.request.resource_type.lower() in self.block_resource_types:
-                    await route.abort()
-                else:
-                    await route.continue_()
+    async def _release_context(self, context: BrowserContext, reuse: bool):
+        uses = self._ctx_uses.get(id(context), 0) + 1
+        if reuse and self.browser is not None and uses < self.context_max_reuse and self._pool_has_room():
+            try:
+                for page in context.pages:
+                    await page.close()
+                await context.clear_cookies()
+                await context.clear_permissions()
+            except PlaywrightError:
+                pass
+            except BaseException:
+                # Cancelled mid-reset: still close the context rather than leak it in Chromium.
+                await self._discard_context(context)
+                raise
+            else:
+                # Re-check: a concurrent release may have filled the pool during the awaits above.
+                if self._pool_has_room():
+                    self._ctx_uses[id(context)] = uses
+                    self._ctx_pool.put_nowait(context)
+                    return
 
-            await context.route("**/*", route_handler)
+        await self._discard_context(context)
 
+    async def _discard_context(self, context: BrowserContext):
+        self._ctx_uses.pop(id(context), None)
+        try:
+            # Shielded so a cancellation arriving now can't leave the context open.
+            await asyncio.shield(context.close())
+        except PlaywrightError:
+            pass
+
+    async def _open_page(self, context: BrowserContext, width: int, height: int):
         page = await context.new_page()
         page.set_default_timeout(self.timeout_ms)
+        if (width, height) != self.DEFAULT_VIEWPORT:
+            await page.set_viewport_size({"width": width, "height": height})
+        return page
+
+    @asynccontextmanager
+    async def page_context(self, *, width: int = 1280, height: int = 800, deadline: Optional[float] = None):
+        # deadline is an event-loop time bounding setup (context + page); Playwright puts no
+        # timeout on these calls. Teardown is deliberately left unbounded.
+        if not self.browser:
+            raise BrowserUnavailableError("Browser is not started")
+
+        context = await self._acquire_context(time_left(deadline))
+        reuse = False
         try:
+            page = await asyncio.wait_for(self._open_page(context, width, height), time_left(deadline))
             yield page
+            # Only contexts that finished cleanly go back to the pool.
+            reuse = True
         finally:
-            await context.close()
+            await self._release_context(context, reuse)
 
 
 browser_manager = BrowserManager.from_env()
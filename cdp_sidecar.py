@@ -0,0 +1,85 @@
+"""Run one headless Chromium per host that every service worker can share.
+
+Start this once, then point the workers at it with
+SHARED_CDP_URL=http://127.0.0.1:9222 (or the printed webSocketDebuggerUrl).
+"""
+
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+from playwright.sync_api import sync_playwright
+
+from browser import browser_manager
+
+
+# Launched directly rather than through Playwright, so pass the headless-server switches
+# Playwright would otherwise add itself.
+_SIDECAR_ARGS = [
+    "--disable-background-networking",
+    "--disable-background-timer-throttling",
+    "--disable-backgrounding-occluded-windows",
+    "--disable-breakpad",
+    "--disable-client-side-phishing-detection",
+    "--disable-extensions",
+    "--disable-ipc-flooding-protection",
+    "--disable-renderer-backgrounding",
+    "--metrics-recording-only",
+    "--mute-audio",
+    "--no-first-run",
+]
+
+
+def _chromium_executable() -> str:
+    with sync_playwright() as p:
+        return p.chromium.executable_path
+
+
+def _wait_for_ws_url(port: int, proc: subprocess.Popen, timeout_s: float = 30.0) -> str:
+    deadline = time.monotonic() + timeout_s
+    url = f"http://127.0.0.1:{port}/json/version"
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"Chromium exited with code {proc.returncode}")
+        try:
+            with urllib.request.urlopen(url, timeout=1) as resp:
+                return json.load(resp)["webSocketDebuggerUrl"]
+        except (urllib.error.URLError, ConnectionError, KeyError, ValueError):
+            time.sleep(0.2)
+    raise RuntimeError(f"Chromium did not expose {url} within {timeout_s}s")
+
+
+def main() -> int:
+    port = int(os.getenv("CDP_PORT", "9222"))
+    address = os.getenv("CDP_ADDRESS", "127.0.0.1")
+    proc = subprocess.Popen(
+        [
+            _chromium_executable(),
+            "--headless=new",
+            f"--remote-debugging-port={port}",
+            f"--remote-debugging-address={address}",
+            *_SIDECAR_ARGS,
+            *browser_manager.launch_args,
+            "about:blank",
+        ]
+    )
+    signal.signal(signal.SIGTERM, lambda *_: proc.terminate())
+    try:
+        print(_wait_for_ws_url(port, proc), flush=True)
+        return proc.wait()
+    except KeyboardInterrupt:
+        proc.terminate()
+        return proc.wait()
+    except RuntimeError as exc:
+        print(str(exc), file=sys.stderr)
+        proc.kill()
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,47 +1,132 @@
 import os
-import base64
-from typing import Literal, Optional
+import asyncio
+import gzip
+import hmac
+from contextlib import asynccontextmanager
+from typing import Annotated, Literal, Optional, Union
 
-from fastapi import Depends, FastAPI, HTTPException, Request
+import msgspec
 
-_browser_start_error: Optional[str] = None
+try:
+    import pybase64 as _b64
+except ImportError:  # pragma: no cover - SIMD encoder is optional
+    import base64 as _b64
+
+from fastapi import Depends, FastAPI, HTTPException, Query, Request, Response
 from pydantic import AnyHttpUrl, BaseModel, Field
 from playwright.async_api import Error as PlaywrightError, TimeoutError as PlaywrightTimeoutError
 
-from browser import browser_manager, BrowserUnavailableError
+from browser import browser_manager, BrowserUnavailableError, time_left
 
-app = FastAPI(title="Playwright Browser Service")
+
+_browser_start_error: Optional[str] = None
+_pool_warm_error: Optional[str] = None
 
 API_TOKEN = os.getenv("API_TOKEN")
+_API_TOKEN_B = API_TOKEN.encode() if API_TOKEN else None
+# Admin endpoints are only registered when this separate token is set.
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+_ADMIN_TOKEN_B = ADMIN_TOKEN.encode() if ADMIN_TOKEN else None
+_BEARER_PREFIXES = ("Bearer ", "bearer ", "BEARER ")
+MAX_CONCURRENT_PAGES = int(os.getenv("MAX_CONCURRENT_PAGES", "4"))
+ADMISSION_TIMEOUT_MS = int(os.getenv("ADMISSION_TIMEOUT_MS", "1000"))
+POOL_WARM = int(os.getenv("CONTEXT_POOL_WARM", "2"))
+# Hard ceiling on a request's context/page setup and page work; individual Playwright calls
+# can otherwise chain timeouts. Teardown sits outside it so a finished request is never cancelled.
+REQUEST_DEADLINE_S = browser_manager.timeout_ms / 1000 + 2
 
 
 def _error_detail(kind: str, message: str) -> dict:
     return {"type": kind, "message": message}
 
 
-async def verify_token(request: Request) -> None:
-    if not API_TOKEN:
-        return
+def _check_bearer(request: Request, expected: bytes) -> None:
     auth = request.headers.get("authorization", "")
-    if not auth.lower().startswith("bearer "):
+    if not auth.startswith(_BEARER_PREFIXES):
         raise HTTPException(
             status_code=401,
             detail=_error_detail("unauthorized", "Missing Bearer token"),
             headers={"WWW-Authenticate": "Bearer"},
         )
     token = auth.split(" ", 1)[1].strip()
-    if token != API_TOKEN:
+    if not hmac.compare_digest(token.encode(), expected):
         raise HTTPException(status_code=403, detail=_error_detail("forbidden", "Invalid token"))
 
 
+async def verify_token(request: Request) -> None:
+    if not API_TOKEN:
+        return
+    _check_bearer(request, _API_TOKEN_B)
+
+
+async def verify_admin_token(request: Request) -> None:
+    _check_bearer(request, _ADMIN_TOKEN_B)
+
+
 def _require_browser() -> None:
-    if not browser_manager.is_ready():
+    if browser_manager.browser is None:
         raise HTTPException(
             status_code=503,
             detail=_error_detail("browser_unavailable", "Browser is not ready"),
         )
 
 
+# Order matters: FastAPI resolves these in sequence, so auth is checked first.
+_BROWSER_DEPENDENCIES = [Depends(verify_token), Depends(_require_browser)]
+
+
+class Admission:
+    """Caps in-flight browser work; unlike a Semaphore the cap can be resized at runtime."""
+
+    def __init__(self, cap: int):
+        self.n = 0
+        self.cap = cap
+        self.cv = asyncio.Condition()
+
+    async def acquire(self) -> None:
+        async with self.cv:
+            try:
+                await self.cv.wait_for(lambda: self.n < self.cap)
+            except asyncio.CancelledError:
+                # Don't swallow a wakeup meant for the next waiter.
+                if self.n < self.cap:
+                    self.cv.notify(1)
+                raise
+            self.n += 1
+
+    async def release(self) -> None:
+        async with self.cv:
+            self.n -= 1
+            self.cv.notify(1)
+
+    async def resize(self, cap: int) -> None:
+        async with self.cv:
+            self.cap = cap
+            self.cv.notify_all()
+
+
+admission = Admission(MAX_CONCURRENT_PAGES)
+
+
+@asynccontextmanager
+async def _admitted():
+    try:
+        await asyncio.wait_for(admission.acquire(), timeout=ADMISSION_TIMEOUT_MS / 1000)
+    except asyncio.TimeoutError:
+        raise HTTPException(
+            status_code=503,
+            detail=_error_detail("overloaded", "Too many concurrent requests"),
+        )
+    try:
+        yield
+    finally:
+        await admission.release()
+
+
+def _gzip_html(html: str) -> bytes:
+    return gzip.compress(html.encode("utf-8"), compresslevel=1)
+
+
 def _ensure_url_allowed(url: str) -> None:
     if not browser_manager.is_url_allowed(url):
         raise HTTPException(
@@ -50,6 +135,10 @@ def _ensure_url_allowed(url: str) -> None:
         )
 
 
+class ConcurrencyRequest(BaseModel):
+    max_concurrent_pages: int = Field(ge=1, le=256)
+
+
 class ScreenshotRequest(BaseModel):
     url: AnyHttpUrl
     width: int = Field(default=1280, ge=200, le=4096)
@@ -60,28 +149,70 @@ class ScreenshotRequest(BaseModel):
 class NavigateRequest(BaseModel):
     url: AnyHttpUrl
     wait_until: Optional[Literal["load", "domcontentloaded", "networkidle"]] = None
+    include_body: bool = False
 
 
-class ExecuteRequest(BaseModel):
-    url: AnyHttpUrl
-    script: str = Field(min_length=1, max_length=10000)
+# JSON responses go through a response model (or typed return) so FastAPI can
+# serialize them straight to bytes with Pydantic instead of json.dumps.
+class ScreenshotResponse(BaseModel):
+    image_base64: str
+
+
+class NavigateResponse(BaseModel):
+    title: str
+    url: str
+    html: str
+
+
+class NavigateErrorResponse(BaseModel):
+    status: int
+    url: str
+
+
+# /execute is decoded and validated by msgspec in C instead of building a Pydantic model.
+# The URL pattern rejects whitespace, control characters and backslashes, which
+# browsers would otherwise strip or reinterpret before the allow-list sees them.
+# msgspec matches with re.search, so anchor with \A/\Z ($ also matches before a final "\n").
+class ExecuteRequest(msgspec.Struct):
+    url: Annotated[str, msgspec.Meta(pattern=r"(?i)\Ahttps?://[^\x00-\x20\x7f\\]+\Z", max_length=2083)]
+    script: Annotated[str, msgspec.Meta(min_length=1, max_length=10000)]
 
 
-@app.on_event("startup")
-async def _startup() -> None:
+_execute_decoder = msgspec.json.Decoder(ExecuteRequest)
+
+
+async def _parse_execute_request(request: Request) -> ExecuteRequest:
+    try:
+        return _execute_decoder.decode(await request.body())
+    except msgspec.DecodeError as exc:
+        raise HTTPException(status_code=422, detail=_error_detail("validation_error", str(exc)))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
     # Don't crash the whole app if Playwright/Chromium can't start.
     # Surface the error via /health so we can debug on Zeabur.
-    global _browser_start_error
+    global _browser_start_error, _pool_warm_error
     try:
         await browser_manager.start()
         _browser_start_error = None
     except Exception as exc:
         _browser_start_error = str(exc)
+    if browser_manager.is_ready():
+        # Pre-create contexts for the default viewport so the first requests skip new_context().
+        # A failure here only costs latency; requests create contexts on demand.
+        try:
+            await browser_manager.warm_contexts(POOL_WARM)
+            _pool_warm_error = None
+        except Exception as exc:
+            _pool_warm_error = str(exc)
+    try:
+        yield
+    finally:
+        await browser_manager.stop()
 
 
-@app.on_event("shutdown")
-async def _shutdown() -> None:
-    await browser_manager.stop()
+app = FastAPI(title="Playwright Browser Service", lifespan=lifespan)
 
 
 @app.get("/health")
@@ -92,83 +223,149 @@ async def health() -> dict:
     }
     if _browser_start_error:
         payload["browser_error"] = _browser_start_error
+    if _pool_warm_error:
+        payload["pool_warm_error"] = _pool_warm_error
     return payload
 
 
-@app.post("/screenshot", dependencies=[Depends(verify_token)])
-async def screenshot(payload: ScreenshotRequest) -> dict:
-    _require_browser()
-    _ensure_url_allowed(str(payload.url))
+@app.post("/screenshot", dependencies=_BROWSER_DEPENDENCIES, response_model=ScreenshotResponse)
+async def screenshot(
+    payload: ScreenshotRequest,
+    as_base64: bool = Query(default=False, alias="base64"),
+) -> Union[Response, dict]:
+    url = str(payload.url)
+    _ensure_url_allowed(url)
 
-    try:
-        async with browser_manager.page_context(width=payload.width, height=payload.height) as page:
-            await page.goto(
-                str(payload.url),
-                wait_until="load",
-                timeout=browser_manager.timeout_ms,
-            )
-            png_bytes = await page.screenshot(full_page=payload.full_page, type="png")
-    except PlaywrightTimeoutError:
-        raise HTTPException(status_code=504, detail=_error_detail("timeout", "Navigation timed out"))
-    except PlaywrightError as exc:
-        raise HTTPException(status_code=502, detail=_error_detail("playwright_error", str(exc)))
-    except BrowserUnavailableError as exc:
-        raise HTTPException(status_code=503, detail=_error_detail("browser_unavailable", str(exc)))
-    except Exception as exc:
-        raise HTTPException(status_code=500, detail=_error_detail("internal_error", str(exc)))
-
-    return {"image_base64": base64.b64encode(png_bytes).decode("ascii")}
-
-
-@app.post("/navigate", dependencies=[Depends(verify_token)])
-async def navigate(payload: NavigateRequest) -> dict:
-    _require_browser()
-    _ensure_url_allowed(str(payload.url))
-
-    wait_until = payload.wait_until or "load"
-
-    try:
-        async with browser_manager.page_context() as page:
-            await page.goto(
-                str(payload.url),
-                wait_until=wait_until,
-                timeout=browser_manager.timeout_ms,
-            )
-            title = await page.title()
-            final_url = page.url
-            html = await page.content()
-    except PlaywrightTimeoutError:
-        raise HTTPException(status_code=504, detail=_error_detail("timeout", "Navigation timed out"))
-    except PlaywrightError as exc:
-        raise HTTPException(status_code=502, detail=_error_detail("playwright_error", str(exc)))
-    except BrowserUnavailableError as exc:
-        raise HTTPException(status_code=503, detail=_error_detail("browser_unavailable", str(exc)))
-    except Exception as exc:
-        raise HTTPException(status_code=500, detail=_error_detail("internal_error", str(exc)))
-
-    return {"title": title, "url": final_url, "html": html}
+    async def _capture(page) -> bytes:
+        await page.goto(
+            url,
+            wait_until="domcontentloaded",
+            timeout=browser_manager.timeout_ms,
+        )
+        await browser_manager.settle(page, fonts=True)
+        return await page.screenshot(full_page=payload.full_page, type="png")
+
+    async with _admitted():
+        try:
+            deadline = asyncio.get_running_loop().time() + REQUEST_DEADLINE_S
+            async with browser_manager.page_context(
+                width=payload.width, height=payload.height, deadline=deadline
+            ) as page:
+                png_bytes = await asyncio.wait_for(_capture(page), timeout=time_left(deadline))
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=504, detail=_error_detail("timeout", "Request exceeded its time budget"))
+        except PlaywrightTimeoutError:
+            raise HTTPException(status_code=504, detail=_error_detail("timeout", "Navigation timed out"))
+        except PlaywrightError as exc:
+            raise HTTPException(status_code=502, detail=_error_detail("playwright_error", str(exc)))
+        except BrowserUnavailableError as exc:
+            raise HTTPException(status_code=503, detail=_error_detail("browser_unavailable", str(exc)))
+        except Exception as exc:
+            raise HTTPException(status_code=500, detail=_error_detail("internal_error", str(exc)))
+
+    if not as_base64:
+        return Response(content=png_bytes, media_type="image/png")
+    # Multi-MB encodes would otherwise stall every other request on the loop.
+    encoded = await asyncio.get_running_loop().run_in_executor(None, _b64.b64encode, png_bytes)
+    return {"image_base64": encoded.decode("ascii")}
+
+
+@app.post(
+    "/navigate",
+    dependencies=_BROWSER_DEPENDENCIES,
+    response_model=Union[NavigateResponse, NavigateErrorResponse],
+)
+async def navigate(
+    payload: NavigateRequest,
+    request: Request,
+    as_json: bool = Query(default=False, alias="json"),
+) -> Union[Response, dict]:
+    url = str(payload.url)
+    _ensure_url_allowed(url)
+
+    wait_until = payload.wait_until or "domcontentloaded"
+
+    async def _load(page) -> dict:
+        response = await page.goto(
+            url,
+            wait_until=wait_until,
+            timeout=browser_manager.timeout_ms,
+        )
+        # Error pages are rarely wanted; skip the title/content round-trips.
+        if response is not None and response.status >= 400 and not payload.include_body:
+            return {"status": response.status, "url": page.url}
+        if payload.wait_until is None:
+            await browser_manager.settle(page)
+        title, html = await asyncio.gather(page.title(), page.content())
+        return {"title": title, "url": page.url, "html": html}
+
+    async with _admitted():
+        try:
+            deadline = asyncio.get_running_loop().time() + REQUEST_DEADLINE_S
+            async with browser_manager.page_context(deadline=deadline) as page:
+                result = await asyncio.wait_for(_load(page), timeout=time_left(deadline))
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=504, detail=_error_detail("timeout", "Request exceeded its time budget"))
+        except PlaywrightTimeoutError:
+            raise HTTPException(status_code=504, detail=_error_detail("timeout", "Navigation timed out"))
+        except PlaywrightError as exc:
+            raise HTTPException(status_code=502, detail=_error_detail("playwright_error", str(exc)))
+        except BrowserUnavailableError as exc:
+            raise HTTPException(status_code=503, detail=_error_detail("browser_unavailable", str(exc)))
+        except Exception as exc:
+            raise HTTPException(status_code=500, detail=_error_detail("internal_error", str(exc)))
+
+    if as_json or "html" not in result:
+        return result
+
+    headers = {
+        "X-Page-Title": _b64.b64encode(result["title"].encode("utf-8")).decode("ascii"),
+        "X-Final-URL": result["url"],
+        "Vary": "Accept-Encoding",
+    }
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        body = await asyncio.get_running_loop().run_in_executor(None, _gzip_html, result["html"])
+        headers["Content-Encoding"] = "gzip"
+    else:
+        body = result["html"].encode("utf-8")
+    return Response(content=body, media_type="text/html", headers=headers)
+
+
+@app.post("/execute", dependencies=_BROWSER_DEPENDENCIES)
+async def execute(payload: ExecuteRequest = Depends(_parse_execute_request)) -> dict:
+    url = payload.url
+    _ensure_url_allowed(url)
+
+    async def _run(page):
+        await page.goto(
+            url,
+            wait_until="domcontentloaded",
+            timeout=browser_manager.timeout_ms,
+        )
+        return await page.evaluate(payload.script)
+
+    async with _admitted():
+        try:
+            deadline = asyncio.get_running_loop().time() + REQUEST_DEADLINE_S
+            async with browser_manager.page_context(deadline=deadline) as page:
+                result = await asyncio.wait_for(_run(page), timeout=time_left(deadline))
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=504, detail=_error_detail("timeout", "Request exceeded its time budget"))
+        except PlaywrightTimeoutError:
+            raise HTTPException(status_code=504, detail=_error_detail("timeout", "Navigation timed out"))
+        except PlaywrightError as exc:
+            raise HTTPException(status_code=502, detail=_error_detail("playwright_error", str(exc)))
+        except BrowserUnavailableError as exc:
+            raise HTTPException(status_code=503, detail=_error_detail("browser_unavailable", str(exc)))
+        except Exception as exc:
+            raise HTTPException(status_code=500, detail=_error_detail("internal_error", str(exc)))
 
+    return {"result": result}
 
-@app.post("/execute", dependencies=[Depends(verify_token)])
-async def execute(payload: ExecuteRequest) -> dict:
-    _require_browser()
-    _ensure_url_allowed(str(payload.url))
 
-    try:
-        async with browser_manager.page_context() as page:
-            await page.goto(
-                str(payload.url),
-                wait_until="domcontentloaded",
-                timeout=browser_manager.timeout_ms,
-            )
-            result = await page.evaluate(payload.script)
-    except PlaywrightTimeoutError:
-        raise HTTPException(status_code=504, detail=_error_detail("timeout", "Navigation timed out"))
-    except PlaywrightError as exc:
-        raise HTTPException(status_code=502, detail=_error_detail("playwright_error", str(exc)))
-    except BrowserUnavailableError as exc:
-        raise HTTPException(status_code=503, detail=_error_detail("browser_unavailable", str(exc)))
-    except Exception as exc:
-        raise HTTPException(status_code=500, detail=_error_detail("internal_error", str(exc)))
+if ADMIN_TOKEN:
 
-    return {"result": result}
+    @app.post("/admin/concurrency", dependencies=[Depends(verify_admin_token)])
+    async def set_concurrency(payload: ConcurrencyRequest) -> dict:
+        await admission.resize(payload.max_concurrent_pages)
+        return {"max_concurrent_pages": admission.cap, "in_flight": admission.n}